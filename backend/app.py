@@ -1,12 +1,25 @@
 import os
+import sys
 import uuid
 import threading
 import subprocess
 import time
+import json
 import logging
 import shutil # Added for file copying
-from flask import Flask, jsonify, request, send_from_directory
+import gzip
+import tempfile
+import hashlib
+import mimetypes
+from contextlib import contextmanager
+from urllib.parse import quote
+import redis
+from celery import Celery, states
+from celery.backends.redis import RedisBackend
+from celery.signals import worker_process_init
+from flask import Flask, Response, abort, jsonify, request, send_file, stream_with_context
 from flask_cors import CORS
+from werkzeug.security import safe_join
 
 # --- Configuration ---
 # Assuming this script (app.py) is in /Users/frog_wch/playground/Research/Projects/nlp/chatbot/backend/
@@ -14,12 +27,33 @@ CHATBOT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 NLP_HOMEWORK_DIR = os.path.join(CHATBOT_ROOT, "gen", "nlp-homework")
 NLP_OUTPUT_DIR = os.path.join(NLP_HOMEWORK_DIR, "output")
 
+# Interpreter and scripts for the subprocess pipeline. sys.executable is the
+# Python running this process, so the scripts get the same environment's deps
+# rather than whatever `python` resolves to on PATH.
+PYTHON_EXE = sys.executable
+SCRIPT1 = os.path.join(NLP_HOMEWORK_DIR, "generate_raw_output_json.py")
+SCRIPT2 = os.path.join(NLP_HOMEWORK_DIR, "generate_mid_fromraw.py")
+SCRIPT3 = os.path.join(NLP_HOMEWORK_DIR, "visualization.py")
+
 # Attempt to determine the visualization output filename.
 # Default, but we'll try to be smarter if possible or allow override.
 # User confirmed that visualization.py output is not fixed, so we'll search.
 # Let's stick to a primary guess and then search.
 ASSUMED_VISUALIZATION_HTML_FILENAME = "visualization.html"
-DUMMY_HTML_FILENAME = "dummy_visualization.html" # For the dummy task
+# Static report returned by the dummy task; override with USER_STATIC_HTML_SOURCE.
+# The default is a fixture checked in next to this file, so the dummy task
+# works on a fresh checkout and never picks up a real pipeline output.
+USER_STATIC_HTML_SOURCE = os.environ.get(
+    "USER_STATIC_HTML_SOURCE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "dummy_visualization.html"))
+
+# Reports are polled repeatedly by the frontend; let browsers reuse them for a
+# minute and revalidate with ETag/Last-Modified after that.
+OUTPUT_MAX_AGE = 60
+
+# Behind nginx, /outputs/ only authorizes the request and hands the file back
+# to nginx via X-Accel-Redirect, so it is sent with sendfile(2) instead of
+# being copied through Python. See nginx.conf.example for the matching location.
+X_ACCEL_OUTPUTS_PREFIX = "/internal-outputs" if os.environ.get("BEHIND_NGINX") else None
 
 # --- Flask App Setup ---
 app = Flask(__name__)
@@ -27,110 +61,385 @@ CORS(app) # Allow all origins for simplicity in demo
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
+
+# The dummy report never changes at runtime, so read it once here and serve
+# it from memory at /dummy-html.
+try:
+    with open(USER_STATIC_HTML_SOURCE, 'rb') as f:
+        DUMMY_HTML_BYTES = f.read()
+    DUMMY_HTML_ETAG = hashlib.md5(DUMMY_HTML_BYTES).hexdigest()
+except FileNotFoundError:
+    DUMMY_HTML_BYTES = None
+    DUMMY_HTML_ETAG = None
+    logging.error(f"Source HTML file for dummy task not found: {USER_STATIC_HTML_SOURCE}; "
+                  "/api/start-dummy-analysis will return 500 until USER_STATIC_HTML_SOURCE points at an existing file.")
+
 # --- Task Management ---
-# Stores task_id: {"status": "pending/processing/completed/failed", 
-#                   "result_filename": None, "error": None, "message": None}
-tasks = {} 
+# Task state lives in Redis via Celery, so every web worker sees the same view
+# and status survives restarts. Analysis itself runs in dedicated Celery
+# workers: `celery -A app.celery_app worker` from this directory.
+# Only small status/filename payloads go into the result backend, never HTML.
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+# Finished (SUCCESS/FAILURE/REVOKED) task records expire from Redis after
+# TASK_TTL_SECONDS so they can't pile up. Queued and running records get
+# UNFINISHED_TASK_TTL_SECONDS instead, counted from their last state change, so
+# a task waiting for a free worker or in a long stage never looks expired.
+# A much longer-lived "known" marker lets the status endpoints answer 410 Gone
+# for expired tasks and 404 only for ids that never existed.
+TASK_TTL_SECONDS = int(os.environ.get("TASK_TTL_SECONDS", 3600))
+UNFINISHED_TASK_TTL_SECONDS = int(os.environ.get("UNFINISHED_TASK_TTL_SECONDS", 86400))
+TASK_KNOWN_TTL_SECONDS = UNFINISHED_TASK_TTL_SECONDS + TASK_TTL_SECONDS * 24
+
+class AnalysisRedisBackend(RedisBackend):
+    # The stock backend SUBSCRIBEs the dispatching process to a task's result
+    # channel on apply_async, for an AsyncResult.get() we never make: status is
+    # read from Redis directly. Nothing would ever read that connection, so its
+    # replies and every state message published on it pile up until Redis drops
+    # the client. Skip the subscription entirely; storing and publishing results
+    # (what the workers need) is unchanged.
+    def on_task_call(self, producer, task_id):
+        pass
+
+    # result_expires (TASK_TTL_SECONDS) only applies to finished records.
+    def _set_with_state(self, key, value, state):
+        if state in states.READY_STATES:
+            return self.set(key, value)
+        return self.ensure(self._set_unfinished, (key, value))
+
+    # Same SETEX+PUBLISH pipeline as RedisBackend._set, with the longer expiry.
+    def _set_unfinished(self, key, value):
+        with self.client.pipeline() as pipe:
+            pipe.setex(key, UNFINISHED_TASK_TTL_SECONDS, value)
+            pipe.publish(key, value)
+            pipe.execute()
+
+# "<module>:<class>+<url>" selects a custom backend class for the URL.
+celery_app = Celery("analysis", broker=REDIS_URL, backend=f"{__name__}:AnalysisRedisBackend+{REDIS_URL}")
+celery_app.conf.task_track_started = True
+# Each worker process is long-lived and analyses take minutes, so hand out one
+# task at a time instead of prefetching a backlog onto a busy process.
+celery_app.conf.worker_concurrency = int(os.environ.get("ANALYSIS_WORKERS", os.cpu_count() or 1))
+celery_app.conf.worker_prefetch_multiplier = 1
+# With ANALYSIS_IN_PROCESS=1, pool children import the analysis modules on
+# start (see _warm_pipeline_modules).
+celery_app.conf.worker_proc_alive_timeout = float(os.environ.get("WORKER_PROC_ALIVE_TIMEOUT", 120))
+
+celery_app.conf.result_expires = TASK_TTL_SECONDS
+
+# Finished reports are remembered by prompt, so an identical request is
+# answered with the existing file instead of rerunning the pipeline.
+# POST /api/start-analysis?force=true skips the lookup.
+PROMPT_CACHE_TTL_SECONDS = int(os.environ.get("PROMPT_CACHE_TTL_SECONDS", 86400))
+
+# Custom Celery state used while a task moves through the three stages;
+# its meta is {"message": ...}.
+PROCESSING_STATE = "PROCESSING"
+
+# Celery's Redis backend stores each worker-side state change (update_state,
+# the final result) as a GET of the current meta followed by one pipelined
+# SETEX+PUBLISH of the new meta, on a channel named after the task's result
+# key: two round trips per transition. /api/analysis-stream gets the new state
+# in the published message itself without reading it back.
+redis_client = redis.Redis.from_url(REDIS_URL)
+STREAM_KEEPALIVE_SECONDS = 15
+
+def _task_meta_key(task_id):
+    return celery_app.backend.get_key_for_task(task_id)
+
+def _prompt_cache_key(user_prompt):
+    return f"prompt:{hashlib.blake2b(user_prompt.encode('utf-8'), digest_size=16).hexdigest()}"
+
+def _task_known_key(task_id):
+    return f"task-known:{task_id}"
+
+# Record a task's state in the result backend (which picks its expiry by state)
+# and remember that the id was issued.
+def _store_task(task_id, result, state):
+    celery_app.backend.store_result(task_id, result, state)
+    redis_client.set(_task_known_key(task_id), 1, ex=TASK_KNOWN_TTL_SECONDS)
+
+# 410 if the id was issued but its record has expired, 404 otherwise.
+def _missing_task_response(task_id):
+    if redis_client.exists(_task_known_key(task_id)):
+        app.logger.warning(f"Status requested for expired task_id: {task_id}")
+        return jsonify({"error": "Task expired"}), 410
+    app.logger.warning(f"Status requested for unknown task_id: {task_id}")
+    return jsonify({"error": "Task not found"}), 404
+
+# --- In-process Pipeline ---
+# The nlp-homework stages can be imported and called directly instead of being
+# spawned as three separate interpreters. A stage module opts in by exposing:
+#   generate_raw_output_json.run(prompt=...) -> (raw, conclusion)
+#   generate_mid_fromraw.run(raw, conclusion) -> mid
+#   visualization.run(mid, output_path)
+# Intermediate results are passed as Python objects, so no JSON files are
+# written between stages. If the modules can't be imported or don't expose
+# run(), we fall back to the subprocess chain below.
+# Off unless ANALYSIS_IN_PROCESS=1: importing a module runs its top-level code,
+# and the current scripts are plain CLIs, so importing them would parse the
+# worker's argv or run a whole stage. Only enable it once they expose run()
+# and keep their CLI under `if __name__ == "__main__":`.
+ANALYSIS_IN_PROCESS = os.environ.get("ANALYSIS_IN_PROCESS") == "1"
+# Both the imports and the run() calls happen with NLP_HOMEWORK_DIR as the
+# working directory, as the subprocess chain always ran them, so relative
+# paths inside the scripts resolve the same way.
+_pipeline_modules = None
+_pipeline_modules_lock = threading.Lock()
+
+# os.chdir is process-wide. That is safe because Celery's prefork pool runs
+# one task per process at a time; don't use this under a threaded pool.
+@contextmanager
+def _in_homework_dir():
+    previous_cwd = os.getcwd()
+    os.chdir(NLP_HOMEWORK_DIR)
+    try:
+        yield
+    finally:
+        os.chdir(previous_cwd)
+
+def _load_pipeline_modules():
+    global _pipeline_modules
+    if not ANALYSIS_IN_PROCESS:
+        return None
+    with _pipeline_modules_lock:
+        if _pipeline_modules is None:
+            try:
+                if NLP_HOMEWORK_DIR not in sys.path:
+                    sys.path.insert(0, NLP_HOMEWORK_DIR)
+                with _in_homework_dir():
+                    import generate_raw_output_json as g1
+                    import generate_mid_fromraw as g2
+                    import visualization as vis
+                modules = (g1, g2, vis)
+                if all(callable(getattr(m, "run", None)) for m in modules):
+                    _pipeline_modules = modules
+                else:
+                    logging.info("nlp-homework scripts do not expose run(); using subprocess pipeline.")
+                    _pipeline_modules = ()
+            # SystemExit too: a CLI script that calls argparse at import time
+            # exits on the worker's argv instead of raising an Exception.
+            except (Exception, SystemExit) as e:
+                logging.warning(f"Could not import nlp-homework scripts in-process ({e!r}); using subprocess pipeline.")
+                _pipeline_modules = ()
+        return _pipeline_modules or None
+
+# Import the stage modules as soon as a Celery pool process starts, so the first
+# task doesn't pay for their (heavy) imports. Done per child rather than
+# preloaded in the parent: libraries like torch (CUDA) and HTTP clients with
+# live connection pools are not safe to carry across fork().
+# Celery kills a child that hasn't finished worker_process_init within
+# worker_proc_alive_timeout (4s by default) and respawns it, so a cold import
+# would loop forever; the timeout is raised to cover it.
+@worker_process_init.connect
+def _warm_pipeline_modules(**kwargs):
+    if ANALYSIS_IN_PROCESS:
+        _load_pipeline_modules()
+
+def run_pipeline_in_process(task_id, user_prompt, modules, final_html_path, report):
+    g1, g2, vis = modules
+
+    try:
+        with _in_homework_dir():
+            report("Step 1/3: Generating raw JSON...")
+            app.logger.info(f"Task {task_id}: Running generate_raw_output_json.run with prompt: '{user_prompt}'")
+            raw, conclusion = g1.run(prompt=user_prompt)
+
+            report("Step 2/3: Generating intermediate JSON...")
+            app.logger.info(f"Task {task_id}: Running generate_mid_fromraw.run")
+            mid = g2.run(raw, conclusion)
+
+            report("Step 3/3: Generating visualization...")
+            app.logger.info(f"Task {task_id}: Running visualization.run")
+            vis.run(mid, final_html_path)
+    except SystemExit as e:
+        # A stage calling sys.exit() would otherwise take the pool process down
+        # with it; report it as an ordinary task failure instead.
+        raise Exception(f"Analysis stage exited with status {e.code}") from e
+
+# Short per-task tag for intermediates. These already live in a per-task
+# temp dir, so 32 bits is plenty; persistent reports use the full task_id.
+def _task_suffix(task_id):
+    return task_id[:8]
+
+# --- Subprocess Pipeline (default) ---
+# Used unless ANALYSIS_IN_PROCESS=1 and the scripts can be called in-process.
+
+# How much of a failed stage's output to keep in the error message.
+STAGE_LOG_TAIL_BYTES = 4096
+
+def _read_log_tail(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - STAGE_LOG_TAIL_BYTES))
+        return f.read().decode('utf-8', errors='replace')
+
+def _run_script(task_id, script_path, args, log_dir):
+    script_name = os.path.basename(script_path)
+    cmd = (PYTHON_EXE, script_path, *args)
+    # Child output goes straight to per-stage log files rather than through a
+    # pipe into our memory; it is only read back if the stage fails.
+    log_base = os.path.join(log_dir, os.path.splitext(script_name)[0])
+    with open(log_base + ".out", 'wb') as log_out, open(log_base + ".err", 'wb') as log_err:
+        process = subprocess.run(cmd, cwd=NLP_HOMEWORK_DIR, stdout=log_out, stderr=log_err, check=False)
+    if process.returncode != 0:
+        error_msg = f"{script_name} failed: STDOUT: {_read_log_tail(log_base + '.out')} STDERR: {_read_log_tail(log_base + '.err')}"
+        app.logger.error(f"Task {task_id}: {error_msg}")
+        raise Exception(error_msg)
+    app.logger.info(f"Task {task_id}: {script_name} completed.")
+
+# Intermediates only live between two stages, so keep them in tmpfs when the
+# host has one; nothing here needs to reach the block device.
+INTERMEDIATE_TMP_ROOT = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Stage logs can be large (progress bars, verbose output) and are only read
+# back on failure, so they go to a disk-backed temp dir, not tmpfs where
+# they'd sit in RAM for the whole task. Set STAGE_LOG_DIR if the system temp
+# dir is itself tmpfs on this host.
+STAGE_LOG_ROOT = os.environ.get("STAGE_LOG_DIR") or None
+
+# Serialization for the files passed between stages. "msgpack" is faster to
+# encode/decode and smaller than JSON, but the scripts must accept
+# `--format msgpack`, so JSON stays the default.
+INTERMEDIATE_FORMAT = os.environ.get("ANALYSIS_INTERMEDIATE_FORMAT", "json")
+if INTERMEDIATE_FORMAT not in ("json", "msgpack"):
+    raise ValueError(f"Unsupported ANALYSIS_INTERMEDIATE_FORMAT: {INTERMEDIATE_FORMAT}")
+
+def run_pipeline_subprocess(task_id, user_prompt, final_html_path, report):
+    tmp_dir = tempfile.mkdtemp(dir=INTERMEDIATE_TMP_ROOT, prefix=f"task-{task_id}-")
+    log_dir = tempfile.mkdtemp(dir=STAGE_LOG_ROOT, prefix=f"task-{task_id}-logs-")
+    try:
+        _run_pipeline_stages(task_id, user_prompt, final_html_path, report, tmp_dir, log_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+def _run_pipeline_stages(task_id, user_prompt, final_html_path, report, tmp_dir, log_dir):
+    # Define consistent intermediate filenames, using task_id to prevent race conditions.
+    # Scripts run with NLP_HOMEWORK_DIR as cwd, so pass absolute paths.
+    suffix = _task_suffix(task_id)
+    ext = INTERMEDIATE_FORMAT
+    raw_output_filename = os.path.join(tmp_dir, f"raw_output.{suffix}.{ext}")
+    conclusion_filename = os.path.join(tmp_dir, f"conclusion.{suffix}.{ext}")
+    mid_output_filename = os.path.join(tmp_dir, f"mid_output.{suffix}.{ext}")
+    # Only sent when non-default, so scripts without the flag keep working.
+    format_args = ("--format", INTERMEDIATE_FORMAT) if INTERMEDIATE_FORMAT != "json" else ()
+
+    # Step 1: generate_raw_output_json.py with dynamic prompt and output
+    report("Step 1/3: Generating raw JSON...")
+    app.logger.info(f"Task {task_id}: Running generate_raw_output_json.py with prompt: '{user_prompt}'")
+    _run_script(task_id, SCRIPT1, (
+        "--prompt", user_prompt,
+        "--output", raw_output_filename,
+        "--conclusion_output", conclusion_filename,
+        *format_args
+    ), log_dir)
+
+    # Step 2: generate_mid_fromraw.py, pointing to the output of Step 1
+    report("Step 2/3: Generating intermediate JSON...")
+    app.logger.info(f"Task {task_id}: Running generate_mid_fromraw.py")
+    _run_script(task_id, SCRIPT2, (
+        "--raw_input", raw_output_filename,
+        "--conclusion_input", conclusion_filename,
+        "--output", mid_output_filename,
+        *format_args
+    ), log_dir)
+
+    # Step 3: visualization.py
+    report("Step 3/3: Generating visualization...")
+    app.logger.info(f"Task {task_id}: Running visualization.py")
+    _run_script(task_id, SCRIPT3, (
+        "--input", mid_output_filename,
+        "--output", final_html_path,
+        *format_args
+    ), log_dir)
 
 # --- Helper Function for Analysis ---
-def run_analysis_scripts_for_task(task_id, user_prompt):
+# Runs in a Celery worker. Progress is published with update_state; the return
+# value becomes the SUCCESS result and any exception marks the task FAILURE.
+@celery_app.task(bind=True, name="analysis.run_analysis_scripts_for_task")
+def run_analysis_scripts_for_task(self, user_prompt):
+    task_id = self.request.id
+
+    def report(message):
+        self.update_state(state=PROCESSING_STATE, meta={"message": message})
+
     try:
-        current_task = tasks[task_id]
-        current_task["status"] = "processing"
-        current_task["message"] = "Starting analysis..."
+        # No report() here: task_track_started already recorded STARTED.
         app.logger.info(f"Task {task_id}: Starting analysis.")
 
-        # Ensure output directory exists (scripts might assume it does)
-        if not os.path.exists(NLP_OUTPUT_DIR):
-            os.makedirs(NLP_OUTPUT_DIR, exist_ok=True)
-            app.logger.info(f"Task {task_id}: Created NLP_OUTPUT_DIR at {NLP_OUTPUT_DIR}")
-
-        script_cwd = NLP_HOMEWORK_DIR
-        python_executable = "python" # Or specify full path to a venv python if necessary
-
-        # Define consistent intermediate filenames, using task_id to prevent race conditions
-        raw_output_filename = "raw_output.json"
-        conclusion_filename = "conclusion.json"
-        mid_output_filename = "mid_output.json"
-        
-        # Step 1: generate_raw_output_json.py with dynamic prompt and output
-        current_task["message"] = "Step 1/3: Generating raw JSON..."
-        app.logger.info(f"Task {task_id}: Running generate_raw_output_json.py with prompt: '{user_prompt}'")
-        script1_path = os.path.join(NLP_HOMEWORK_DIR, "generate_raw_output_json.py")
-        cmd1 = [
-            python_executable, 
-            script1_path,
-            "--prompt", user_prompt,
-            "--output", raw_output_filename,
-            "--conclusion_output", conclusion_filename
-        ]
-        process1 = subprocess.run(cmd1, cwd=script_cwd, capture_output=True, text=True, check=False, encoding='utf-8')
-        if process1.returncode != 0:
-            error_msg = f"generate_raw_output_json.py failed: STDOUT: {process1.stdout} STDERR: {process1.stderr}"
-            app.logger.error(f"Task {task_id}: {error_msg}")
-            raise Exception(error_msg)
-        app.logger.info(f"Task {task_id}: generate_raw_output_json.py completed. STDOUT: {process1.stdout}")
-
-        # Step 2: generate_mid_fromraw.py, pointing to the output of Step 1
-        current_task["message"] = "Step 2/3: Generating intermediate JSON..."
-        app.logger.info(f"Task {task_id}: Running generate_mid_fromraw.py")
-        script2_path = os.path.join(NLP_HOMEWORK_DIR, "generate_mid_fromraw.py")
-        cmd2 = [
-            python_executable,
-            script2_path,
-            "--raw_input", raw_output_filename,
-            "--conclusion_input", conclusion_filename,
-            "--output", mid_output_filename 
-        ]
-        process2 = subprocess.run(cmd2, cwd=script_cwd, capture_output=True, text=True, check=False, encoding='utf-8')
-        if process2.returncode != 0:
-            error_msg = f"generate_mid_fromraw.py failed: STDOUT: {process2.stdout} STDERR: {process2.stderr}"
-            app.logger.error(f"Task {task_id}: {error_msg}")
-            raise Exception(error_msg)
-        app.logger.info(f"Task {task_id}: generate_mid_fromraw.py completed. STDOUT: {process2.stdout}")
-
-        # Step 3: visualization.py
-        current_task["message"] = "Step 3/3: Generating visualization..."
-        app.logger.info(f"Task {task_id}: Running visualization.py")
-        script3_path = os.path.join(NLP_HOMEWORK_DIR, "visualization.py")
-        
-        # The final report will be placed in the designated output directory
-        final_html_filename = ASSUMED_VISUALIZATION_HTML_FILENAME # e.g., "visualization.html"
+        # The final report will be placed in the designated output directory,
+        # named with the full task_id: reports are kept (and referenced by the
+        # prompt cache), so a short prefix could collide and overwrite one.
+        html_stem, html_ext = os.path.splitext(ASSUMED_VISUALIZATION_HTML_FILENAME)
+        final_html_filename = f"{html_stem}.{task_id}{html_ext}" # e.g., "visualization.<uuid>.html"
         final_html_path = os.path.join(NLP_OUTPUT_DIR, final_html_filename)
 
-        cmd3 = [
-            python_executable,
-            script3_path,
-            "--input", mid_output_filename,
-            "--output", final_html_path
-        ]
-        process3 = subprocess.run(cmd3, cwd=script_cwd, capture_output=True, text=True, check=False, encoding='utf-8')
-        if process3.returncode != 0:
-            error_msg = f"visualization.py failed: STDOUT: {process3.stdout} STDERR: {process3.stderr}"
-            app.logger.error(f"Task {task_id}: {error_msg}")
-            raise Exception(error_msg)
-        app.logger.info(f"Task {task_id}: visualization.py completed. STDOUT: {process3.stdout}")
-        
+        modules = _load_pipeline_modules()
+        if modules:
+            run_pipeline_in_process(task_id, user_prompt, modules, final_html_path, report)
+        else:
+            run_pipeline_subprocess(task_id, user_prompt, final_html_path, report)
+
         # Discover the HTML file produced by visualization.py
         # Since we explicitly defined the output path, we can directly check for it.
         if os.path.exists(final_html_path):
             app.logger.info(f"Task {task_id}: Found expected HTML file: {final_html_filename}")
-            current_task["result_filename"] = final_html_filename
         else:
             error_msg = f"No HTML visualization file found at the expected path: {final_html_path}"
             app.logger.error(f"Task {task_id}: {error_msg}")
             raise Exception(error_msg)
-        
-        current_task["status"] = "completed"
-        current_task["message"] = "Analysis completed successfully."
+
+        _write_gzip_sibling(task_id, final_html_path)
+        redis_client.set(_prompt_cache_key(user_prompt), final_html_filename, ex=PROMPT_CACHE_TTL_SECONDS)
+
         app.logger.info(f"Task {task_id}: Analysis completed. Result file: {final_html_filename}")
+        return {"result_filename": final_html_filename, "message": "Analysis completed successfully."}
 
     except Exception as e:
         app.logger.error(f"Error during analysis for task {task_id}: {str(e)}", exc_info=True)
-        if task_id in tasks: # Check if task_id still exists, could be removed by other logic if any
-            tasks[task_id]["status"] = "failed"
-            tasks[task_id]["error"] = str(e)
-            tasks[task_id]["message"] = f"Analysis failed: {str(e)}"
+        raise
+
+# Compress the finished report once so /outputs/ can serve the .gz as-is.
+# A failure here only costs compression, not the analysis.
+def _write_gzip_sibling(task_id, html_path):
+    try:
+        with open(html_path, 'rb') as src, gzip.open(html_path + ".gz", 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst)
+    except OSError as e:
+        app.logger.warning(f"Task {task_id}: Could not write gzipped copy of {html_path}: {e}")
+
+# Returns None when the task has no record (never existed, or expired).
+# Reads the stored meta in one GET rather than an exists check plus AsyncResult.
+def _task_status(task_id):
+    raw_meta = redis_client.get(_task_meta_key(task_id))
+    if raw_meta is None:
+        return None
+    return _status_from_meta(task_id, raw_meta)
+
+def _status_from_meta(task_id, raw_meta):
+    meta = celery_app.backend.decode_result(raw_meta)
+    state, info = meta["status"], meta["result"]
+    response = {"task_id": task_id}
+
+    if state == states.SUCCESS:
+        response["status"] = "completed"
+        response["message"] = info.get("message", "")
+        if info.get("html_url"):
+            response["html_url"] = info["html_url"]
+        elif info.get("result_filename"):
+            response["html_url"] = f"/outputs/{info['result_filename']}"
+    elif state in (states.FAILURE, states.REVOKED):
+        response["status"] = "failed"
+        response["message"] = f"Analysis failed: {str(info)}"
+        response["error_details"] = str(info)
+    elif state == states.PENDING:
+        response["status"] = "pending"
+        response["message"] = info.get("message", "") if isinstance(info, dict) else ""
+    else: # STARTED, PROCESSING, RETRY
+        response["status"] = "processing"
+        response["message"] = info.get("message", "Starting analysis...") if isinstance(info, dict) else "Starting analysis..."
+    return response
 
 # --- API Endpoints ---
 @app.route('/api/start-analysis', methods=['POST'])
@@ -139,110 +448,140 @@ def start_analysis_endpoint():
     data = request.get_json()
     if not data or 'prompt' not in data:
         return jsonify({"error": "Missing 'prompt' in request body"}), 400
+    if not isinstance(data['prompt'], str):
+        return jsonify({"error": "'prompt' must be a string"}), 400
     user_prompt = data['prompt']
 
     task_id = str(uuid.uuid4())
-    tasks[task_id] = {
-        "status": "pending", 
-        "result_filename": None, 
-        "error": None, 
-        "message": "Task created, awaiting execution."
-    }
+
+    if request.args.get("force", "").lower() not in ("1", "true"):
+        cached_filename = redis_client.get(_prompt_cache_key(user_prompt))
+        # The output file may have been cleaned up since; then just recompute.
+        if cached_filename and os.path.isfile(os.path.join(NLP_OUTPUT_DIR, cached_filename.decode('utf-8'))):
+            cached_filename = cached_filename.decode('utf-8')
+            _store_task(task_id, {
+                "result_filename": cached_filename,
+                "message": "Analysis completed successfully (cached result)."
+            }, states.SUCCESS)
+            app.logger.info(f"Created task {task_id} from cached result {cached_filename} for prompt: '{user_prompt}'")
+            return jsonify({"task_id": task_id, "message": "Analysis started."}), 202
+
+    # Store the PENDING record before queueing so the task is visible (and
+    # distinguishable from an expired one) while it waits for a worker.
+    _store_task(task_id, {"message": "Task queued, waiting for a free analysis worker."}, states.PENDING)
+    # No result subscription is made here; see AnalysisRedisBackend.
+    run_analysis_scripts_for_task.apply_async(args=(user_prompt,), task_id=task_id)
     app.logger.info(f"Created task {task_id} with prompt: '{user_prompt}'")
     
-    thread = threading.Thread(target=run_analysis_scripts_for_task, args=(task_id, user_prompt))
-    thread.daemon = True # Allow main program to exit even if threads are running
-    thread.start()
-    
     return jsonify({"task_id": task_id, "message": "Analysis started."}), 202
 
 @app.route('/api/start-dummy-analysis', methods=['POST'])
 def start_dummy_analysis_endpoint():
     task_id = str(uuid.uuid4())
-    
-    # Prepare the dummy HTML file by copying it to the output directory
-    # AND read its content to be served directly.
-    dummy_html_path_in_output = os.path.join(NLP_OUTPUT_DIR, DUMMY_HTML_FILENAME)
-    html_content_for_response = None
+
+    if DUMMY_HTML_BYTES is None:
+        app.logger.error(f"Source HTML file for dummy task not found: {USER_STATIC_HTML_SOURCE}")
+        _store_task(task_id, Exception(f"源HTML文件 '{USER_STATIC_HTML_SOURCE}' 未找到。"), states.FAILURE)
+        return jsonify({"task_id": task_id, "error": "创建虚拟任务失败，源HTML文件未找到。"}), 500
 
     try:
-        # Ensure NLP_OUTPUT_DIR exists
-        if not os.path.exists(NLP_OUTPUT_DIR):
-            os.makedirs(NLP_OUTPUT_DIR, exist_ok=True)
-            app.logger.info(f"Created NLP_OUTPUT_DIR at {NLP_OUTPUT_DIR} for dummy task.")
-
-        if os.path.exists(USER_STATIC_HTML_SOURCE):
-            # Read the HTML content
-            with open(USER_STATIC_HTML_SOURCE, 'r', encoding='utf-8') as f:
-                html_content_for_response = f.read()
-            
-            # Copying the file can still be useful for direct access/debugging, but not primary for API response
-            shutil.copyfile(USER_STATIC_HTML_SOURCE, dummy_html_path_in_output)
-            app.logger.info(f"Copied '{USER_STATIC_HTML_SOURCE}' to '{dummy_html_path_in_output}' and read its content for task {task_id}")
-            
-            tasks[task_id] = {
-                "status": "completed",
-                # "result_filename": DUMMY_HTML_FILENAME, # Keep for consistency or if direct file serving is still a fallback
-                "html_content": html_content_for_response, #<<< Store actual HTML content
-                "error": None,
-                "message": "虚拟分析任务已完成，HTML内容已准备就绪。",
-                "task_id": task_id
-            }
-            app.logger.info(f"Created and completed dummy task {task_id} with direct HTML content.")
-            return jsonify({"task_id": task_id, "message": "虚拟分析任务已创建并立即完成，HTML内容已直接准备好。"}), 202
-        else:
-            app.logger.error(f"Source HTML file for dummy task not found: {USER_STATIC_HTML_SOURCE}")
-            tasks[task_id] = {
-                "status": "failed", 
-                "result_filename": None, 
-                "html_content": None,
-                "error": f"源HTML文件 '{USER_STATIC_HTML_SOURCE}' 未找到。",
-                "message": "创建虚拟任务失败：源文件丢失。",
-                "task_id": task_id
-            }
-            return jsonify({"task_id": task_id, "error": "创建虚拟任务失败，源HTML文件未找到。"}), 500
+        _store_task(task_id, {
+            "html_url": "/dummy-html",
+            "message": "虚拟分析任务已完成，可通过html_url获取HTML报告。"
+        }, states.SUCCESS)
+        app.logger.info(f"Created and completed dummy task {task_id}.")
+        return jsonify({"task_id": task_id, "html_url": "/dummy-html"}), 202
 
     except Exception as e:
         app.logger.error(f"Error creating dummy task {task_id}: {str(e)}", exc_info=True)
-        tasks[task_id] = {
-            "status": "failed", 
-            "result_filename": None, 
-            "html_content": None,
-            "error": str(e), 
-            "message": f"创建虚拟任务时出错: {str(e)}",
-            "task_id": task_id
-        }
         return jsonify({"task_id": task_id, "error": f"创建虚拟任务时发生服务器错误: {str(e)}"}), 500
 
+@app.route('/dummy-html')
+def dummy_html_endpoint():
+    if DUMMY_HTML_BYTES is None:
+        abort(404)
+    response = Response(DUMMY_HTML_BYTES, mimetype="text/html")
+    response.set_etag(DUMMY_HTML_ETAG)
+    response.cache_control.max_age = OUTPUT_MAX_AGE
+    return response.make_conditional(request)
+
 @app.route('/api/analysis-status/<task_id>', methods=['GET'])
 def analysis_status_endpoint(task_id):
-    task = tasks.get(task_id)
-    if not task:
-        app.logger.warn(f"Status requested for unknown task_id: {task_id}")
-        return jsonify({"error": "Task not found"}), 404
-    
-    response = {
-        "task_id": task_id, 
-        "status": task["status"], 
-        "message": task.get("message", "")
-    }
-    if task["status"] == "completed":
-        if task.get("html_content"):
-            response["html_content"] = task["html_content"]
-        # Fallback or alternative for real analysis tasks if they still use result_filename
-        elif task.get("result_filename"): 
-            response["html_url"] = f"/outputs/{task['result_filename']}"
-            
-    elif task["status"] == "failed":
-        response["error_details"] = task.get("error")
-        
-    return jsonify(response)
+    status = _task_status(task_id)
+    if status is None:
+        return _missing_task_response(task_id)
+    return jsonify(status)
+
+@app.route('/api/analysis-stream/<task_id>', methods=['GET'])
+def analysis_stream_endpoint(task_id):
+    if _task_status(task_id) is None:
+        return _missing_task_response(task_id)
+
+    def generate():
+        pubsub = redis_client.pubsub()
+        # Subscribe before the first read so no transition can slip in between.
+        pubsub.subscribe(_task_meta_key(task_id))
+        try:
+            last_sent = None
+            status = _task_status(task_id)
+            while True:
+                if status is None: # Expired while we were streaming
+                    break
+                if status != last_sent:
+                    yield f"data: {json.dumps(status)}\n\n"
+                    last_sent = status
+                if status["status"] not in ("pending", "processing"):
+                    break
+                message = pubsub.get_message(timeout=STREAM_KEEPALIVE_SECONDS)
+                if message is None:
+                    # Idle: keep the connection open and re-check in case the record expired.
+                    yield ": keep-alive\n\n"
+                    status = _task_status(task_id)
+                elif message["type"] == "message":
+                    status = _status_from_meta(task_id, message["data"])
+                # Otherwise it's the subscribe ack: keep waiting. (Dropping it via
+                # ignore_subscribe_messages makes get_message return None early,
+                # which would look like an idle timeout.)
+        finally:
+            pubsub.close()
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no" # Don't let a proxy buffer the stream
+    return response
 
 # Serve files from the nlp-homework/output directory
 @app.route('/outputs/<path:filename>')
 def serve_output_file_endpoint(filename):
+    path = safe_join(NLP_OUTPUT_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
     app.logger.info(f"Serving file: {filename} from {NLP_OUTPUT_DIR}")
-    return send_from_directory(NLP_OUTPUT_DIR, filename, as_attachment=False)
+
+    if X_ACCEL_OUTPUTS_PREFIX:
+        # nginx handles conditional GET and the .gz sibling (gzip_static) itself.
+        response = Response(mimetype=mimetypes.guess_type(path)[0])
+        response.headers["X-Accel-Redirect"] = f"{X_ACCEL_OUTPUTS_PREFIX}/{quote(filename)}"
+        response.cache_control.max_age = OUTPUT_MAX_AGE
+        return response
+
+    # Prefer the precompressed sibling written by the worker, as long as it
+    # isn't older than the file it was made from.
+    gzip_path = path + ".gz"
+    # A quality check, not `in`: "gzip;q=0" is listed but means "never gzip".
+    if (request.accept_encodings["gzip"] > 0 and os.path.isfile(gzip_path)
+            and os.path.getmtime(gzip_path) >= os.path.getmtime(path)):
+        # download_name keeps Content-Disposition on the .html name; the .gz
+        # is only the transfer encoding.
+        response = send_file(gzip_path, mimetype=mimetypes.guess_type(path)[0],
+                             download_name=os.path.basename(path),
+                             conditional=True, etag=True, max_age=OUTPUT_MAX_AGE)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = send_file(path, conditional=True, etag=True,
+                             last_modified=os.path.getmtime(path), max_age=OUTPUT_MAX_AGE)
+    response.vary.add("Accept-Encoding")
+    return response
 
 @app.route('/api/chat', methods=['POST'])
 def chat_endpoint():
@@ -260,14 +599,18 @@ def chat_endpoint():
     return jsonify({"reply": "Chat functionality with OpenRouter is planned but not yet fully implemented."})
 
 # Ensure the output directory exists at startup, as scripts might rely on it.
-# This is also beneficial for the dummy task if it's called before any real analysis.
+# Celery workers import this module too, so tasks can assume it exists.
 if not os.path.exists(NLP_OUTPUT_DIR):
     os.makedirs(NLP_OUTPUT_DIR, exist_ok=True)
     logging.info(f"Ensured NLP_OUTPUT_DIR exists at startup: {NLP_OUTPUT_DIR}")
 
 # --- Main ---
+# Local development only; in production serve with `gunicorn -c gunicorn.conf.py app:app`.
 if __name__ == '__main__':
     # Port for the backend server
     backend_port = int(os.environ.get("FLASK_PORT", 5001))
+    debug = os.environ.get("FLASK_ENV") == "development"
+    if not debug:
+        app.logger.warning("Running the Flask development server; use gunicorn (see gunicorn.conf.py) for production.")
     app.logger.info(f"Starting Flask backend server on port {backend_port}")
-    app.run(debug=True, host='0.0.0.0', port=backend_port) 
\ No newline at end of file
+    app.run(debug=debug, host='0.0.0.0', port=backend_port, threaded=True) 
\ No newline at end of file
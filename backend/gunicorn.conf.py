@@ -0,0 +1,19 @@
+# Production server settings for the backend:
+#   gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = f"0.0.0.0:{os.environ.get('FLASK_PORT', 5001)}"
+
+# Task state is in Redis, so any number of workers see the same tasks.
+workers = int(os.environ.get("GUNICORN_WORKERS", os.cpu_count() or 1))
+
+# Threaded workers: an open /api/analysis-stream connection holds a thread
+# for the whole analysis, so workers * threads caps the number of clients
+# watching at once - and once a worker's threads are all streaming, its status,
+# /outputs/ and chat requests wait too. Threads mostly sit blocked on Redis,
+# so a high count is cheap; raise GUNICORN_THREADS for more concurrent watchers.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 64))
+
+# Analyses are slow and streams stay open for minutes.
+timeout = 600
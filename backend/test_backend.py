@@ -1,11 +1,14 @@
+import json
 import requests
 import time
+import uuid
 
 # Configuration
 BASE_API_URL = "http://127.0.0.1:5001/api"  # Corrected port and base path for API
 BASE_OUTPUT_URL = "http://127.0.0.1:5001"   # Base URL for accessing output files
-MAX_POLL_ATTEMPTS = 30  # Max number of times to poll for status (e.g., 30 attempts)
-POLL_INTERVAL = 10      # Seconds between polls (e.g., 10 seconds, adjust as needed)
+STREAM_TIMEOUT = 300    # Max seconds to wait on the status stream for a final state
+STREAM_READ_TIMEOUT = 60 # Seconds without any data (the server sends keep-alives every 15s)
+ANALYSIS_PROMPT = "生成5月手卫生培训与专项考核报告"
 
 def print_test_header(test_name):
     print(f"\n--- Running Test: {test_name} ---")
@@ -17,105 +20,102 @@ def print_test_result(success, message=""):
     print("-------------------------------------")
     return success
 
-def test_start_analysis():
-    print_test_header("Start Analysis Endpoint (/api/start-analysis)")
-    url = f"{BASE_API_URL}/start-analysis"
-    task_id = None
-    success = False
+def start_task(url, payload=None, params=None):
+    # POSTs to a task-creating endpoint and returns the task_id from a 202 response, else None.
     try:
-        # Define the prompt to be sent to the backend
-        payload = {"prompt": "生成5月手卫生培训与专项考核报告"}
-        print(f"Sending POST to {url} with payload: {payload}")
-        response = requests.post(url, json=payload)
+        print(f"Sending POST to {url} with payload: {payload}, params: {params}")
+        response = requests.post(url, json=payload, params=params)
         print(f"POST {url} - Status Code: {response.status_code}")
         response_data = response.json()
         print(f"Response JSON: {response_data}")
         if response.status_code == 202: # Accepted
             task_id = response_data.get("task_id")
             if task_id:
-                print(f"Analysis started successfully. Task ID: {task_id}")
-                success = True
-            else:
-                print("Error: 'task_id' not found in response.")
+                print(f"Task created successfully. Task ID: {task_id}")
+                return task_id
+            print("Error: 'task_id' not found in response.")
         else:
-            print(f"Error starting analysis. Details: {response_data.get('error', response.text)}")
+            print(f"Error creating task. Details: {response_data.get('error', response.text)}")
     except requests.exceptions.RequestException as e:
         print(f"Request failed: {e}")
     except requests.exceptions.JSONDecodeError:
         print(f"Failed to decode JSON response: {response.text}")
+    return None
 
+def test_start_analysis(prompt=ANALYSIS_PROMPT, force=False):
+    print_test_header(f"Start Analysis Endpoint (/api/start-analysis{'?force=true' if force else ''})")
+    params = {"force": "true"} if force else None
+    task_id = start_task(f"{BASE_API_URL}/start-analysis", {"prompt": prompt}, params)
+    success = task_id is not None
     print_test_result(success, f"Task ID obtained: {task_id}" if success else "Failed to start analysis.")
-    return task_id if success else None
+    return task_id
+
+def test_start_dummy_analysis():
+    print_test_header("Start Dummy Analysis Endpoint (/api/start-dummy-analysis)")
+    task_id = start_task(f"{BASE_API_URL}/start-dummy-analysis")
+    success = task_id is not None
+    print_test_result(success, f"Task ID obtained: {task_id}" if success else "Failed to start dummy analysis.")
+    return task_id
 
 def test_analysis_status_and_completion(task_id):
     print_test_header(f"Analysis Status & Completion (Task ID: {task_id})")
     if not task_id:
         return None, print_test_result(False, "No task_id provided for status check.")
 
-    status_url = f"{BASE_API_URL}/analysis-status/{task_id}"
+    stream_url = f"{BASE_API_URL}/analysis-stream/{task_id}"
     html_url_path = None
     final_status_achieved = False
     final_success = False
+    current_status = None
+    deadline = time.time() + STREAM_TIMEOUT
 
-    for attempt in range(MAX_POLL_ATTEMPTS):
-        try:
-            print(f"Polling status for task {task_id}... Attempt {attempt + 1}/{MAX_POLL_ATTEMPTS}")
-            response = requests.get(status_url)
-            print(f"GET {status_url} - Status Code: {response.status_code}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                print(f"Response JSON: {data}")
-                current_status = data.get("status")
-                message = data.get("message", "")
-                print(f"Current task status: {current_status} - {message}")
-
-                if current_status == "completed":
-                    html_url_path = data.get("html_url")
-                    if html_url_path:
-                        print(f"Analysis completed successfully. HTML URL path: {html_url_path}")
-                        final_success = True
-                    else:
-                        print("Error: Analysis completed but 'html_url' not found.")
-                        final_success = False
-                    final_status_achieved = True
-                    break
-                elif current_status == "failed":
-                    error_details = data.get("error_details", "No error details provided.")
-                    print(f"Analysis failed. Error: {error_details}")
-                    final_success = False
-                    final_status_achieved = True
-                    break
-                elif current_status in ["pending", "processing"]:
-                    time.sleep(POLL_INTERVAL) # Wait before next poll
-                else:
-                    print(f"Unknown status received: {current_status}")
-                    final_success = False
-                    final_status_achieved = True
-                    break
-            elif response.status_code == 404:
-                print(f"Error: Task ID {task_id} not found (404).")
-                final_success = False
-                final_status_achieved = True
-                break
+    try:
+        print(f"Opening status stream for task {task_id}: {stream_url}")
+        with requests.get(stream_url, stream=True, timeout=(5, STREAM_READ_TIMEOUT)) as response:
+            print(f"GET {stream_url} - Status Code: {response.status_code}")
+            if response.status_code != 200:
+                print(f"Error opening status stream. Response: {response.text}")
             else:
-                print(f"Error fetching status. Status code: {response.status_code}, Response: {response.text}")
-                final_success = False
-                # Don't break immediately, maybe a transient server error
-                time.sleep(POLL_INTERVAL)
+                # Each status transition arrives as one 'data: {...}' line; ':' lines are keep-alives.
+                for line in response.iter_lines(decode_unicode=True):
+                    if time.time() > deadline:
+                        break
+                    if not line or not line.startswith("data: "):
+                        continue
+                    data = json.loads(line[len("data: "):])
+                    print(f"Event JSON: {data}")
+                    current_status = data.get("status")
+                    message = data.get("message", "")
+                    print(f"Current task status: {current_status} - {message}")
+
+                    if current_status == "completed":
+                        html_url_path = data.get("html_url")
+                        if html_url_path:
+                            print(f"Analysis completed successfully. HTML URL path: {html_url_path}")
+                            final_success = True
+                        else:
+                            print("Error: Analysis completed but 'html_url' not found.")
+                            final_success = False
+                        final_status_achieved = True
+                        break
+                    elif current_status == "failed":
+                        error_details = data.get("error_details", "No error details provided.")
+                        print(f"Analysis failed. Error: {error_details}")
+                        final_success = False
+                        final_status_achieved = True
+                        break
+                    elif current_status not in ["pending", "processing"]:
+                        print(f"Unknown status received: {current_status}")
+                        final_success = False
+                        final_status_achieved = True
+                        break
+    except requests.exceptions.RequestException as e:
+        print(f"Request failed while reading status stream: {e}")
+    except json.JSONDecodeError as e:
+        print(f"Failed to decode status event: {e}")
 
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed during status polling: {e}")
-            final_success = False
-            # Don't break immediately, maybe a transient network issue
-            time.sleep(POLL_INTERVAL)
-        except requests.exceptions.JSONDecodeError:
-            print(f"Failed to decode JSON response during status polling: {response.text}")
-            # Don't break, let it retry
-            time.sleep(POLL_INTERVAL)
-        
     if not final_status_achieved:
-        print(f"Polling timed out after {MAX_POLL_ATTEMPTS * POLL_INTERVAL} seconds. Last known status might be '{current_status}'.")
+        print(f"No final status within {STREAM_TIMEOUT} seconds. Last known status might be '{current_status}'.")
         final_success = False
 
     print_test_result(final_success, f"Final status for task {task_id}: {'Completed with HTML URL' if final_success and html_url_path else ('Completed without HTML URL' if final_success else 'Failed or Timed Out')}")
@@ -145,6 +145,62 @@ def test_get_output_file(html_url_path):
     print_test_result(success, f"Successfully fetched {full_url}" if success else f"Failed to fetch {full_url}")
     return success
 
+def test_cached_analysis(expected_html_url):
+    # Re-running a prompt whose report already exists must be answered from the
+    # prompt cache: the new task is completed immediately, with the same report.
+    print_test_header("Cached Analysis (same prompt again)")
+    task_id = test_start_analysis()
+    if not task_id:
+        return print_test_result(False, "Failed to start the repeated analysis.")
+
+    url = f"{BASE_API_URL}/analysis-status/{task_id}"
+    success = False
+    try:
+        response = requests.get(url, timeout=10)
+        print(f"GET {url} - Status Code: {response.status_code}")
+        data = response.json()
+        print(f"Response JSON: {data}")
+        if data.get("status") != "completed":
+            print(f"Error: expected an immediate 'completed', got '{data.get('status')}'.")
+        elif data.get("html_url") != expected_html_url:
+            print(f"Error: expected html_url {expected_html_url}, got {data.get('html_url')}.")
+        else:
+            success = True
+    except requests.exceptions.RequestException as e:
+        print(f"Request failed: {e}")
+    except requests.exceptions.JSONDecodeError:
+        print(f"Failed to decode JSON response: {response.text}")
+
+    return print_test_result(success, "Repeated prompt served from cache." if success else "Repeated prompt was not served from cache.")
+
+def test_forced_analysis(previous_html_url):
+    # ?force=true skips the prompt cache, so the pipeline runs again and writes a new report.
+    print_test_header("Forced Analysis (same prompt, ?force=true)")
+    task_id = test_start_analysis(force=True)
+    html_url = test_analysis_status_and_completion(task_id)
+    success = html_url is not None and html_url != previous_html_url
+    if html_url == previous_html_url:
+        print(f"Error: forced run returned the cached html_url {html_url}.")
+    return print_test_result(success, f"Forced run produced a new report: {html_url}" if success else "Forced run did not produce a new report.")
+
+def test_unknown_task_status():
+    # A task id that was never issued must be 404; 410 is reserved for issued tasks whose record expired.
+    task_id = str(uuid.uuid4())
+    print_test_header(f"Unknown Task Status (Task ID: {task_id})")
+    success = True
+    for url in (f"{BASE_API_URL}/analysis-status/{task_id}", f"{BASE_API_URL}/analysis-stream/{task_id}"):
+        try:
+            response = requests.get(url, timeout=10)
+            print(f"GET {url} - Status Code: {response.status_code}")
+            if response.status_code != 404:
+                print(f"Error: expected 404 for an unknown task, got {response.status_code}. Response: {response.text}")
+                success = False
+        except requests.exceptions.RequestException as e:
+            print(f"Request failed: {e}")
+            success = False
+
+    return print_test_result(success, "Unknown task ids return 404." if success else "Unknown task ids did not return 404.")
+
 def test_chat_endpoint():
     print_test_header("Chat Endpoint (/api/chat)")
     url = f"{BASE_API_URL}/chat"
@@ -179,7 +235,7 @@ if __name__ == "__main__":
     
     retrieved_html_url = None
     if task_id:
-        # Test 2: Poll for Analysis Status and Completion
+        # Test 2: Follow the status stream until the analysis completes
         retrieved_html_url = test_analysis_status_and_completion(task_id)
     else:
         print("\nSkipping Analysis Status & Completion test due to failure in starting analysis.")
@@ -190,7 +246,27 @@ if __name__ == "__main__":
     elif task_id : # Only print skip if analysis was started but didn't complete successfully with a URL
         print("\nSkipping Get Output File test: Analysis did not complete successfully with an HTML URL.")
 
-    # Test 4: Chat Endpoint
+    if retrieved_html_url:
+        # Test 4: The same prompt again is answered from the prompt cache
+        test_cached_analysis(retrieved_html_url)
+        # Test 5: ?force=true recomputes and yields a new report
+        test_forced_analysis(retrieved_html_url)
+    else:
+        print("\nSkipping Cached/Forced Analysis tests: no completed analysis to compare against.")
+
+    # Test 6: Chat Endpoint
     test_chat_endpoint()
+
+    # Test 7: Unknown task ids are 404 (not 410, which means expired)
+    test_unknown_task_status()
+
+    # Test 8: Dummy Analysis - the report is fetched through its html_url like a real one
+    dummy_task_id = test_start_dummy_analysis()
+    if dummy_task_id:
+        dummy_html_url = test_analysis_status_and_completion(dummy_task_id)
+        if dummy_html_url:
+            test_get_output_file(dummy_html_url)
+        else:
+            print("\nSkipping Get Output File test for dummy task: no HTML URL returned.")
     
     print("\n===== Backend Integration Test Suite Finished =====") 
\ No newline at end of file
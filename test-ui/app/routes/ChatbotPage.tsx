@@ -90,19 +90,11 @@ export default function ChatbotPage() {
 
   useEffect(() => {
     if (taskId && (analysisStatus === 'processing' || analysisStatus === 'loading')) {
-      const intervalId = setInterval(async () => {
+      // The backend pushes every status change over SSE, so there's no polling interval.
+      const eventSource = new EventSource(`${BACKEND_URL}/api/analysis-stream/${taskId}`);
+      eventSource.onmessage = (event) => {
         try {
-          const response = await fetch(`${BACKEND_URL}/api/analysis-status/${taskId}`);
-          if (!response.ok) {
-            // If task ID is not found (404), it might mean backend restarted or task expired
-            // Or a genuine server error
-            if (response.status === 404) {
-                throw new Error(`任务ID ${taskId} 未找到。可能已过期或后端服务已重启。`);
-            }
-            const errorData = await response.json();
-            throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
-          }
-          const data: TaskStatusResponse = await response.json();
+          const data: TaskStatusResponse = JSON.parse(event.data);
           
           setStatusMessage(data.message || '正在获取状态...');
 
@@ -121,13 +113,13 @@ export default function ChatbotPage() {
             }
             setAnalysisStatus('success');
             setTaskId(null); // Clear task ID as it's done
-            clearInterval(intervalId);
+            eventSource.close();
           } else if (data.status === 'failed') {
             setAnalysisStatus('error');
             setErrorMessage(data.error_details || data.message || '分析过程中发生未知错误。');
             setStatusMessage(data.message || '分析失败。');
             setTaskId(null); // Clear task ID
-            clearInterval(intervalId);
+            eventSource.close();
           } else if (data.status === 'processing') {
             setAnalysisStatus('processing');
           } else if (data.status === 'pending') {
@@ -135,16 +127,30 @@ export default function ChatbotPage() {
             setStatusMessage(data.message || '任务正在等待执行...');
           }
         } catch (error) {
-          console.error("Error fetching analysis status:", error);
+          console.error("Error handling analysis status:", error);
           setAnalysisStatus('error');
           setErrorMessage(error instanceof Error ? error.message : '获取分析状态失败。');
           setStatusMessage('获取分析状态时出错。');
           setTaskId(null);
-          clearInterval(intervalId);
+          eventSource.close();
+        }
+      };
+      eventSource.onerror = () => {
+        // A dropped connection (proxy blip, backend restart) leaves the source
+        // CONNECTING and the browser reconnects by itself; the backend then
+        // resends the current status. Only an error response (404 unknown /
+        // 410 expired task) closes it for good.
+        if (eventSource.readyState !== EventSource.CLOSED) {
+          setStatusMessage('与后端的连接中断，正在重新连接...');
+          return;
         }
-      }, 10000); // Poll every 10 seconds
+        setAnalysisStatus('error');
+        setErrorMessage(`无法获取任务 ${taskId} 的状态。任务可能已过期或不存在。`);
+        setStatusMessage('获取分析状态时出错。');
+        setTaskId(null);
+      };
 
-      return () => clearInterval(intervalId);
+      return () => eventSource.close();
     }
   }, [taskId, analysisStatus]);
 